@@ -8,10 +8,21 @@ import threading
 import time
 import codecs
 import signal
+import io
 import collections
 import functools
 import re
 
+IS_WINDOWS = sys.platform == "win32"
+
+if IS_WINDOWS:
+    # Hide the console window on Windows
+    STARTUPINFO = subprocess.STARTUPINFO()
+    STARTUPINFO.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+else:
+    STARTUPINFO = None
+    import fcntl
+
 ComplexityResult = collections.namedtuple("ComplexityResult",
                                           ["modified_complexity",
                                            "traditional_complexity",
@@ -21,25 +32,100 @@ ComplexityResult = collections.namedtuple("ComplexityResult",
                                            "filename",
                                            "definition_line",
                                            "function_name"])
+# Matched against many lines of output at once, so separators must not be
+# allowed to run across line breaks.
 ComplexityLineRE = re.compile(
-    r"^(?P<modified_complexity>\d+)\s+"
-    "(?P<traditional_complexity>\d+)\s+(?P<num_statements>\d+)\s+"
-    "(?P<first_line>\d+)\s+(?P<num_lines>\d+)\s+(?P<filename>.*)"
-    "\((?P<definition_line>\d+)\):\s+"
-    "(?P<function_name>.*)")
-
-
-def parse_complexity_results(view, lines_to_parse):
+    r"^(?P<modified_complexity>\d+)[ \t]+"
+    r"(?P<traditional_complexity>\d+)[ \t]+(?P<num_statements>\d+)[ \t]+"
+    r"(?P<first_line>\d+)[ \t]+(?P<num_lines>\d+)[ \t]+(?P<filename>.*)"
+    r"\((?P<definition_line>\d+)\):[ \t]+"
+    r"(?P<function_name>.*)", re.MULTILINE | re.ASCII)
+
+
+# Results are sorted into (low, medium, high) complexity buckets. These
+# tuples are indexed the same way.
+BUCKET_NAMES = ("low_complexity", "medium_complexity", "high_complexity")
+BUCKET_CSS = ("color: var(--bluish);", "", "color: var(--redish);")
+
+
+def complexity_result_from_match(match):
+    (modified_complexity, traditional_complexity, num_statements, first_line,
+     num_lines, filename, definition_line, function_name) = match.groups()
+    return ComplexityResult(int(modified_complexity),
+                            int(traditional_complexity),
+                            int(num_statements),
+                            int(first_line),
+                            int(num_lines),
+                            filename,
+                            int(definition_line),
+                            function_name)
+
+
+def parse_complexity_results(text, offset=0):
+    # offset is where text starts in the output panel
     complexity_results = []
-    for line in lines_to_parse:
-        match = ComplexityLineRE.match(view.substr(line))
-        if match:
-            complexity_results.append((
-                ComplexityResult(*match.groups()), line))
+    for match in ComplexityLineRE.finditer(text):
+        complexity_results.append((
+            complexity_result_from_match(match),
+            sublime.Region(offset + match.start(), offset + match.end())))
 
     return complexity_results
 
 
+def line_start_offsets(text):
+    # Offset of the start of every line, plus the end of the text so the
+    # line after the last one can be looked up the same way text_point()
+    # would clamp it.
+    return ([0] + [match.end() for match in re.finditer("\n", text)] +
+            [len(text)])
+
+
+# is_enabled runs on every menu refresh, avoid a stat() each time. Only a
+# path that exists is remembered, pmccabe may still be installed after a
+# miss. Reset whenever the settings change.
+_executable_check = (None, False)
+
+
+def executable_exists(path):
+    global _executable_check
+    checked_path, exists = _executable_check
+    if checked_path == path and exists:
+        return True
+
+    exists = os.path.exists(path)
+    if exists:
+        _executable_check = (path, exists)
+    return exists
+
+
+def reset_executable_check():
+    global _executable_check
+    _executable_check = (None, False)
+
+
+# The object Sublime hands back stays up to date as the settings files
+# change, so it is loaded once and shared by the command in every window.
+_settings = None
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = sublime.load_settings("pmccabe.sublime-settings")
+        # A single callback for the whole plugin, removed again in
+        # plugin_unloaded
+        _settings.add_on_change("pmccabe", PmccabeCommand._reload_settings)
+        PmccabeCommand._reload_settings()
+    return _settings
+
+
+def plugin_unloaded():
+    # Otherwise a reloaded or upgraded package leaves the old module's
+    # callback attached to the settings
+    sublime.load_settings("pmccabe.sublime-settings").clear_on_change(
+        "pmccabe")
+
+
 class ProcessListener(object):
     def on_data(self, proc, data):
         pass
@@ -48,71 +134,152 @@ class ProcessListener(object):
         pass
 
 
+class LineDecoder(object):
+    # Decodes output only up to the last complete line seen so far. pmccabe
+    # emits one record per line, so this never splits a character across
+    # reads and each chunk can be decoded with a single bytes.decode call.
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.pending = bytearray()
+
+    def decode(self, data, final=False):
+        self.pending.extend(data)
+        if final:
+            end = len(self.pending)
+        else:
+            end = self.pending.rfind(b"\n") + 1
+        if end == 0:
+            return ""
+
+        text = self.pending[:end].decode(self.encoding, "replace")
+        del self.pending[:end]
+        return text
+
+
+class TextLineDecoder(object):
+    # Same as LineDecoder for encodings where \n is not a lone 0x0A byte
+    # (UTF-16, UTF-32, ...), so lines can only be found after decoding.
+    def __init__(self, encoding):
+        self.decoder = codecs.getincrementaldecoder(encoding)("replace")
+        self.pending = ""
+
+    def decode(self, data, final=False):
+        text = self.pending + self.decoder.decode(data, final)
+        if final:
+            end = len(text)
+        else:
+            end = text.rfind("\n") + 1
+
+        self.pending = text[end:]
+        return text[:end]
+
+
+def line_decoder(encoding):
+    if "\n".encode(encoding) == b"\n":
+        return LineDecoder(encoding)
+    return TextLineDecoder(encoding)
+
+
 class AsyncProcess(object):
-    def __init__(self, executable, file_path, listener):
+    # stdout of a full-file scan can be large, so read it in big chunks.
+    # stderr only ever carries short error messages.
+    READ_CHUNK = 1 << 20
+    STDERR_READ_CHUNK = 1 << 16
+    # How often, in milliseconds, the pipes are checked for more output
+    PUMP_INTERVAL = 10
+    # Read buffers are handed back here once a process is done with them,
+    # so repeated runs don't allocate a new one each time.
+    read_buffer_pool = []
+
+    def __init__(self, executable, file_path, listener, read_chunk=None):
         if not file_path:
             raise ValueError("Need a file to analyze")
 
         self.listener = listener
+        self.read_chunk = read_chunk or self.READ_CHUNK
         self.killed = False
         self.start_time = time.time()
 
-        # Hide the console window on Windows
-        startupinfo = None
-        if os.name == "nt":
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-
-        if sys.platform == "win32":
-            preexec_fn = None
-        else:
-            preexec_fn = os.setsid
+        # Whatever can be set up without the process is, so that a bad
+        # encoding fails before pmccabe is spawned rather than after.
+        stdout_decoder = line_decoder(listener.encoding)
+        stderr_decoder = line_decoder(listener.encoding)
+        # Only one pipe is read at a time, so they can share a buffer.
+        # Windows reads each pipe on its own thread instead.
+        self.read_buffer = None if IS_WINDOWS else self.acquire_read_buffer()
 
-        if sys.platform == "win32":
-            self.proc = subprocess.Popen(
-                [executable, "-v", file_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                stdin=subprocess.PIPE,
-                startupinfo=startupinfo,
-                shell=False)
-        elif sys.platform == "darwin" or sys.platform == "linux":
+        self.proc = None
+        try:
             self.proc = subprocess.Popen(
                 [executable, "-v", file_path],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 stdin=subprocess.PIPE,
-                startupinfo=startupinfo,
-                preexec_fn=preexec_fn,
+                startupinfo=STARTUPINFO,
+                # Own process group, so kill() can take down the whole tree
+                preexec_fn=None if IS_WINDOWS else os.setsid,
                 shell=False)
 
+            self.pipes = {}
+            for pipe, decoder, chunk_size in (
+                    (self.proc.stdout, stdout_decoder, self.read_chunk),
+                    (self.proc.stderr, stderr_decoder,
+                     self.STDERR_READ_CHUNK)):
+                if not IS_WINDOWS:
+                    # The pipes are made non-blocking and drained from
+                    # Sublime's async worker, so no reader threads are
+                    # needed.
+                    fileno = pipe.fileno()
+                    flags = fcntl.fcntl(fileno, fcntl.F_GETFL)
+                    fcntl.fcntl(fileno, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+                self.pipes[pipe] = (decoder, chunk_size)
+
+        except Exception:
+            if self.proc is not None:
+                # Nothing would ever read its output or wait for it
+                self.proc.kill()
+                self.proc.wait()
+            self.release_read_buffer()
+            raise
+
+    def start(self):
+        # Output is only read from here on, so the caller can publish this
+        # process before any of it reaches the listener.
+        if not IS_WINDOWS:
+            sublime.set_timeout_async(self.pump, 0)
+            return
+
+        # Pipes can't be made non-blocking on Windows, so each pipe gets its
+        # own reader thread there.
         if self.proc.stdout:
             threading.Thread(
-                target=self.read_fileno,
-                args=(self.proc.stdout.fileno(), True),
+                target=self.read_pipe,
+                args=(self.proc.stdout, True),
                 name="pmccabe-stdout"
             ).start()
 
         if self.proc.stderr:
             threading.Thread(
-                target=self.read_fileno,
-                args=(self.proc.stderr.fileno(), False),
+                target=self.read_pipe,
+                args=(self.proc.stderr, False),
                 name="pmccabe-stderr"
             ).start()
 
     def kill(self):
         if not self.killed:
             self.killed = True
-            if sys.platform == "win32":
+            if IS_WINDOWS:
                 # terminate would not kill process opened by the shell cmd.exe,
                 # it will only kill cmd.exe leaving the child running
-                startupinfo = subprocess.STARTUPINFO()
-                startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
                 subprocess.Popen(
                     "taskkill /PID %d /T /F" % self.proc.pid,
-                    startupinfo=startupinfo)
+                    startupinfo=STARTUPINFO)
             else:
-                os.killpg(self.proc.pid, signal.SIGTERM)
+                try:
+                    os.killpg(self.proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    # Already exited and reaped
+                    pass
                 self.proc.terminate()
             self.listener = None
 
@@ -122,28 +289,85 @@ class AsyncProcess(object):
     def exit_code(self):
         return self.proc.poll()
 
-    def read_fileno(self, fileno, execute_finished):
-        decoder_cls = codecs.getincrementaldecoder(self.listener.encoding)
-        decoder = decoder_cls('replace')
-        while True:
-            data = decoder.decode(os.read(fileno, 2**16))
+    def read_once(self, pipe, decoder, chunk_size, buf=None):
+        # Returns False once the pipe has reached EOF and been closed
+        if buf is None:
+            data = os.read(pipe.fileno(), chunk_size)
+        else:
+            # Read into the preallocated buffer instead of a new bytes object
+            # per read, the decoder copies out what it needs.
+            data = buf[:os.readv(pipe.fileno(), [buf[:chunk_size]])]
+        # An empty read is EOF, flush whatever the decoder is holding
+        text = decoder.decode(data, not data)
+
+        if text and self.listener:
+            self.listener.on_data(self, text)
+
+        if not data:
+            # Through the file object, so Popen doesn't close the same
+            # descriptor a second time later on.
+            pipe.close()
+            return False
+        return True
 
-            if len(data) > 0:
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                try:
-                    os.close(fileno)
-                except OSError:
+    def read_pipe(self, pipe, execute_finished):
+        # Only used on Windows, where pmccabe writes \r\n line endings.
+        # Sublime Text always uses a single \n separator in memory, let the
+        # decoder translate them as part of decoding.
+        decoder, chunk_size = self.pipes[pipe]
+        decoder = io.IncrementalNewlineDecoder(decoder, translate=True)
+        while self.read_once(pipe, decoder, chunk_size):
+            pass
+
+        if execute_finished and self.listener:
+            self.listener.on_finished(self)
+
+    def acquire_read_buffer(self):
+        try:
+            read_buffer = self.read_buffer_pool.pop()
+        except IndexError:
+            read_buffer = None
+
+        if read_buffer is None or len(read_buffer) != self.read_chunk:
+            # read_buffer_size may have changed since it was pooled
+            read_buffer = memoryview(bytearray(self.read_chunk))
+        return read_buffer
+
+    def release_read_buffer(self):
+        if self.read_buffer is not None:
+            self.read_buffer_pool.append(self.read_buffer)
+            self.read_buffer = None
+
+    def pump(self):
+        for pipe, (decoder, chunk_size) in list(self.pipes.items()):
+            try:
+                # Drain everything available, the pipe is done once this
+                # reaches EOF.
+                while self.read_once(pipe, decoder, chunk_size,
+                                     self.read_buffer):
                     pass
-                if execute_finished and self.listener:
-                    self.listener.on_finished(self)
-                break
+                del self.pipes[pipe]
+            except BlockingIOError:
+                # Non-blocking pipe with nothing in it yet
+                pass
+
+        if self.pipes:
+            sublime.set_timeout_async(self.pump, self.PUMP_INTERVAL)
+            return
+
+        self.release_read_buffer()
+        if self.listener:
+            self.listener.on_finished(self)
 
 
 class PmccabeCommand(sublime_plugin.WindowCommand, ProcessListener):
-    BLOCK_SIZE = 2**14
-    text_queue = collections.deque()
+    text_queue = []
+    output_size = 0
+    complexity_buckets = ([], [], [])
+    proc = None
+    # Set by run() until start_process has spawned pmccabe, a kill or
+    # another run in between replaces it to call the spawn off.
+    pending_start = None
     text_queue_proc = None
     text_queue_lock = threading.Lock()
     _phantom_content = """
@@ -157,37 +381,66 @@ class PmccabeCommand(sublime_plugin.WindowCommand, ProcessListener):
     </body>
     """
 
-    def _get_pmccabe_executable(self):
-        s = sublime.load_settings("pmccabe.sublime-settings")
-        pmccabe_executable = s.get("pmccabe_executable", "/usr/bin/pmccabe")
-        return pmccabe_executable
-
-    def _get_high_complexity_threshold(self):
-        s = sublime.load_settings("pmccabe.sublime-settings")
-        return s.get("high_complexity_threshold", 15)
-
-    def _get_medium_complexity_threshold(self):
-        s = sublime.load_settings("pmccabe.sublime-settings")
-        return s.get("medium_complexity_threshold", 7)
-
-    def _get_output_highlighting_enabled(self):
-        s = sublime.load_settings("pmccabe.sublime-settings")
-        return s.get("output_highlighting", False)
-
-    def _get_phantoms_enabled(self):
-        s = sublime.load_settings("pmccabe.sublime-settings")
-        return s.get("phantoms_enabled", True)
+    @classmethod
+    def _reload_settings(cls):
+        # Values used while handling results are kept on the command class,
+        # shared by every window, rather than looked up once per result.
+        # Refreshed whenever the settings change.
+        reset_executable_check()
+        cls.high_complexity_threshold = int(
+            cls._get_high_complexity_threshold())
+        cls.medium_complexity_threshold = int(
+            cls._get_medium_complexity_threshold())
+        # Used to size a read buffer, which can't be empty or negative
+        cls.read_buffer_size = max(1, int(cls._get_read_buffer_size()))
+        cls.output_highlighting_enabled = \
+            cls._get_output_highlighting_enabled()
+        cls.phantoms_enabled = cls._get_phantoms_enabled()
+
+    @classmethod
+    def _get_pmccabe_executable(cls):
+        return get_settings().get("pmccabe_executable", "/usr/bin/pmccabe")
+
+    @classmethod
+    def _get_read_buffer_size(cls):
+        return get_settings().get("read_buffer_size", AsyncProcess.READ_CHUNK)
+
+    @classmethod
+    def _get_high_complexity_threshold(cls):
+        return get_settings().get("high_complexity_threshold", 15)
+
+    @classmethod
+    def _get_medium_complexity_threshold(cls):
+        return get_settings().get("medium_complexity_threshold", 7)
+
+    @classmethod
+    def _get_output_highlighting_enabled(cls):
+        return get_settings().get("output_highlighting", False)
+
+    @classmethod
+    def _get_phantoms_enabled(cls):
+        return get_settings().get("phantoms_enabled", True)
 
     def run(self, kill=False, encoding="utf-8", quiet=False, **kwargs):
         # clear the text_queue
         with self.text_queue_lock:
-            self.text_queue.clear()
+            self.text_queue = []
+            self.output_size = 0
+            self.complexity_buckets = ([], [], [])
             self.text_queue_proc = None
 
+            # Whatever is running or about to be spawned is superseded
+            cancelled = self.proc is not None or \
+                self.pending_start is not None
+            proc, self.proc = self.proc, None
+            self.pending_start = None if kill else object()
+            pending_start = self.pending_start
+
+        if proc is not None and proc.poll():
+            proc.kill()
+
         if kill:
-            if self.proc:
-                self.proc.kill()
-                self.proc = None
+            if cancelled:
                 self.append_string(None, "[Cancelled]")
             return
 
@@ -201,115 +454,145 @@ class PmccabeCommand(sublime_plugin.WindowCommand, ProcessListener):
         self.quiet = quiet
         self.debug_text = ""
 
-        try:
-            self.proc = AsyncProcess(self._get_pmccabe_executable(),
-                                     self.target_view.file_name(), self,
-                                     **kwargs)
+        # Loads the settings the first time around
+        get_settings()
 
-            with self.text_queue_lock:
-                self.text_queue_proc = self.proc
+        # Spawning the process can take a while on big files, keep it off
+        # the UI thread.
+        sublime.set_timeout_async(functools.partial(
+            self.start_process, self._get_pmccabe_executable(),
+            self.target_view.file_name(), self.read_buffer_size,
+            kwargs, pending_start), 0)
+
+    def start_process(self, executable, file_path, read_buffer_size, kwargs,
+                      pending_start):
+        with self.text_queue_lock:
+            if pending_start is not self.pending_start:
+                # Cancelled before pmccabe was even spawned
+                return
+
+        try:
+            proc = AsyncProcess(executable, file_path, self,
+                                read_buffer_size, **kwargs)
 
         except Exception as e:
+            with self.text_queue_lock:
+                if pending_start is not self.pending_start:
+                    return
+                self.pending_start = None
             self.append_string(None, str(e) + "\n")
             self.append_string(None, self.debug_text + "\n")
             if not self.quiet:
                 self.append_string(None, "[Finished]")
+            return
 
-    def sort_results_into_buckets(self, results):
-        output_regions = {
-            "low_complexity": [],
-            "medium_complexity": [],
-            "high_complexity": []
-        }
-
-        for result, line_region in results:
-            if int(result.modified_complexity) > self._get_high_complexity_threshold():
-                output_regions["high_complexity"].append((result, line_region))
-            elif int(result.modified_complexity) > self._get_medium_complexity_threshold():
-                output_regions["medium_complexity"].append((result, line_region))
+        # Publish the process before its output starts arriving, so that
+        # output isn't mistaken for a stale process.
+        with self.text_queue_lock:
+            started = pending_start is self.pending_start
+            if started:
+                self.pending_start = None
+                self.proc = proc
+                self.text_queue_proc = proc
+
+        if not started:
+            # Cancelled while pmccabe was being spawned
+            proc.kill()
+            proc.release_read_buffer()
+            return
+        proc.start()
+
+    def sort_results_into_buckets(self, results, complexity_buckets):
+        # Adds results to the existing (low, medium, high) buckets
+        low, medium, high = complexity_buckets
+
+        high_threshold = self.high_complexity_threshold
+        medium_threshold = self.medium_complexity_threshold
+        add_low = low.append
+        add_medium = medium.append
+        add_high = high.append
+
+        for entry in results:
+            complexity = entry[0].modified_complexity
+            if complexity > high_threshold:
+                add_high(entry)
+            elif complexity > medium_threshold:
+                add_medium(entry)
             else:
-                output_regions["low_complexity"].append((result, line_region))
-
-        return output_regions
-
-    def get_scope_for_bucket(self, result_bucket):
-        if result_bucket == "high_complexity":
-            return "invalid.illegal"
-        elif result_bucket == "medium_complexity":
-            return ""
-        else:
-            return "comment"
-
-    def get_css_for_bucket(self, result_bucket):
-        if result_bucket == "high_complexity":
-            return "color: var(--redish);"
-        elif result_bucket == "medium_complexity":
-            return ""
-        else:
-            return "color: var(--bluish);"
-
-    def get_all_output_lines(self):
-        return self.output_panel.lines(
-            sublime.Region(0, self.output_panel.size())
+                add_low(entry)
+
+    def highlight_results(self, complexity_buckets):
+        low, medium, high = complexity_buckets
+        # No gutter icons. Medium complexity has no scope to style with,
+        # so skip drawing its regions altogether.
+        self.output_panel.add_regions(
+            "Pmccabe_low_complexity",
+            [region for _, region in low],
+            "comment", "", 0
+        )
+        self.output_panel.add_regions(
+            "Pmccabe_medium_complexity",
+            [region for _, region in medium],
+            "", "", sublime.DRAW_NO_OUTLINE | sublime.DRAW_NO_FILL
+        )
+        self.output_panel.add_regions(
+            "Pmccabe_high_complexity",
+            [region for _, region in high],
+            "invalid.illegal", "", 0
         )
-
-    def highlight_results(self):
-        output_lines = self.get_all_output_lines()
-        results = parse_complexity_results(self.output_panel, output_lines)
-        complexity_buckets = self.sort_results_into_buckets(results)
-
-        for bucket, regions in complexity_buckets.items():
-            output_regions = [region[1] for region in regions]
-            self.output_panel.add_regions(
-                "Pmccabe_" + bucket,
-                output_regions,
-                self.get_scope_for_bucket(bucket)
-            )
 
     def change_regions_from_output_to_active(self, complexity_buckets):
-        new_buckets = {}
-        for bucket, results in complexity_buckets.items():
-            new_buckets[bucket] = []
+        # One substr instead of two text_point calls per result
+        line_starts = line_start_offsets(self.target_view.substr(
+            sublime.Region(0, self.target_view.size())))
+        last_row = len(line_starts) - 1
+
+        new_buckets = []
+        for results in complexity_buckets:
+            new_bucket = []
             for result, _ in results:
-                region_start = self.target_view.text_point(
-                    # text_point uses 0-offset for row and column
-                    int(result.definition_line) - 1, 0
-                )
-                region_end = self.target_view.text_point(
-                    int(result.definition_line), 0
-                )
-                new_buckets[bucket].append((
+                # definition_line is 1-offset, line_starts is 0-offset
+                row = min(result.definition_line, last_row)
+                region_start = line_starts[row - 1]
+                region_end = line_starts[row]
+                new_bucket.append((
                     result, sublime.Region(region_start, region_end)
                 ))
-        return new_buckets
-
-    def add_phantoms_to_active_view(self):
-        output_lines = self.get_all_output_lines()
-        results = parse_complexity_results(self.output_panel, output_lines)
-        complexity_buckets = self.sort_results_into_buckets(results)
+            new_buckets.append(new_bucket)
+        return tuple(new_buckets)
+
+    def get_phantom_templates(self):
+        # Only the complexities differ between phantoms of the same bucket,
+        # fill in everything else up front and leave %d placeholders.
+        return [PmccabeCommand._phantom_content.format(
+                    bucket=bucket,
+                    css_text_color=css,
+                    modified="%d",
+                    traditional="%d")
+                for bucket, css in zip(BUCKET_NAMES, BUCKET_CSS)]
+
+    def add_phantoms_to_active_view(self, complexity_buckets):
         complexity_buckets = self.change_regions_from_output_to_active(complexity_buckets)
-        phantoms = []
-
-        for bucket, regions in complexity_buckets.items():
-            for result, region in regions:
-                phantoms.append(sublime.Phantom(
-                    region,
-                    PmccabeCommand._phantom_content.format(
-                        bucket=bucket,
-                        css_text_color=self.get_css_for_bucket(bucket),
-                        modified=result.modified_complexity,
-                        traditional=result.traditional_complexity
-                    ),
-                    sublime.LAYOUT_BLOCK
-                ))
+        phantoms = [
+            sublime.Phantom(
+                region,
+                template % (result.modified_complexity,
+                            result.traditional_complexity),
+                sublime.LAYOUT_BLOCK
+            )
+            for template, regions in zip(self.get_phantom_templates(),
+                                         complexity_buckets)
+            for result, region in regions
+        ]
         self.phantoms.update(phantoms)
 
     def is_enabled(self, kill=False, **kwargs):
         if kill:
-            return (self.proc is not None) and self.proc.poll()
+            return self.pending_start is not None or \
+                ((self.proc is not None) and self.proc.poll())
 
         pmccabe_executable = self._get_pmccabe_executable()
-        if not os.path.exists(pmccabe_executable):
+        if not executable_exists(pmccabe_executable):
             sublime.error_message("The pmccabe executable provided at '{}' "
                                   "does not exist".format(pmccabe_executable))
             return False
@@ -317,46 +600,41 @@ class PmccabeCommand(sublime_plugin.WindowCommand, ProcessListener):
         return True
 
     def append_string(self, proc, str):
-        was_empty = False
+        # Returns the offset str will have in the output panel, or None if
+        # it was dropped. The panel only ever receives what goes through
+        # here, so the offset is known without asking the view.
         with self.text_queue_lock:
             if proc != self.text_queue_proc and proc:
                 # a second call to exec has been made before the first one
                 # finished, ignore it instead of intermingling the output.
                 proc.kill()
-                return
+                return None
 
-            if len(self.text_queue) == 0:
-                was_empty = True
-                self.text_queue.append("")
+            offset = self.output_size
+            self.output_size += len(str)
 
-            available = self.BLOCK_SIZE - len(self.text_queue[-1])
-
-            if len(str) < available:
-                cur = self.text_queue.pop()
-                self.text_queue.append(cur + str)
-            else:
-                self.text_queue.append(str)
+            # a non-empty queue already has a flush scheduled
+            was_empty = len(self.text_queue) == 0
+            self.text_queue.append(str)
 
         if was_empty:
             sublime.set_timeout(self.service_text_queue, 0)
+        return offset
 
     def service_text_queue(self):
-        is_empty = False
         with self.text_queue_lock:
-            if len(self.text_queue) == 0:
-                # this can happen if a new build was started, which will clear
-                # the text_queue
-                return
+            text_queue, self.text_queue = self.text_queue, []
 
-            characters = self.text_queue.popleft()
-            is_empty = (len(self.text_queue) == 0)
+        if len(text_queue) == 0:
+            # this can happen if a new build was started, which will clear
+            # the text_queue
+            return
 
+        # Everything queued since the last flush goes out in one append
         self.output_panel.run_command(
             'append',
-            {'characters': characters, 'force': True, 'scroll_to_end': True})
-
-        if not is_empty:
-            sublime.set_timeout(self.service_text_queue, 1)
+            {'characters': "".join(text_queue), 'force': True,
+             'scroll_to_end': True})
 
     def finish(self, proc):
         if not self.quiet:
@@ -374,19 +652,26 @@ class PmccabeCommand(sublime_plugin.WindowCommand, ProcessListener):
         if proc != self.proc:
             return
 
-        if self._get_output_highlighting_enabled():
-            self.highlight_results()
-        if self._get_phantoms_enabled():
-            self.add_phantoms_to_active_view()
+        # Results were parsed and sorted as the output came in
+        if self.output_highlighting_enabled:
+            self.highlight_results(self.complexity_buckets)
+        if self.phantoms_enabled:
+            self.add_phantoms_to_active_view(self.complexity_buckets)
 
         sublime.status_message("Analysis finished")
 
     def on_data(self, proc, data):
-        # Normalize newlines, Sublime Text always uses a single \n separator
-        # in memory.
-        data = data.replace('\r\n', '\n').replace('\r', '\n')
-
-        self.append_string(proc, data)
+        # Only Windows output has \r\n line endings, and read_pipe already
+        # translates those
+        offset = self.append_string(proc, data)
+
+        # AsyncProcess only ever hands over whole lines, so each chunk can
+        # be parsed on its own while pmccabe is still running.
+        if offset is not None and (self.output_highlighting_enabled or
+                                   self.phantoms_enabled):
+            self.sort_results_into_buckets(
+                parse_complexity_results(data, offset),
+                self.complexity_buckets)
 
     def on_finished(self, proc):
         sublime.set_timeout(functools.partial(self.finish, proc), 0)